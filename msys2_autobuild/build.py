@@ -1,4 +1,5 @@
 import fnmatch
+import glob
 import json
 import os
 import time
@@ -7,20 +8,21 @@ import shutil
 import stat
 import subprocess
 import tempfile
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from contextlib import contextmanager
+from hashlib import sha256
 from pathlib import Path, PurePath, PurePosixPath
 from subprocess import check_call
-from typing import Any, Dict, Generator, List, Sequence, TypeVar, Tuple
+from typing import Any, Dict, Generator, List, Sequence, Tuple
 
 from github.GitReleaseAsset import GitReleaseAsset
 
 from .config import ArchType, BuildType, Config
-from .gh import (CachedAssets, download_asset, get_asset_filename,
-                 get_current_run_urls, get_release, get_repo, upload_asset,
-                 wait_for_api_limit_reset)
+from .gh import (CachedAssets, asset_file_is_uptodate, download_asset,
+                 get_asset_filename, get_current_run_urls, get_release,
+                 get_repo, upload_asset, wait_for_api_limit_reset)
 from .queue import Package
-from .utils import SCRIPT_DIR, PathLike
+from .utils import SCRIPT_DIR, PackageFilenames, PathLike, file_lock
 
 
 class BuildError(Exception):
@@ -122,6 +124,36 @@ def run_cmd(msys2_root: PathLike, args: Sequence[PathLike], **kwargs: Any) -> No
     check_call([executable, '-lc'] + [shlex_join([str(a) for a in args])], env=env, **kwargs)
 
 
+def run_pacman(msys2_root: PathLike, args: Sequence[PathLike], **kwargs: Any) -> None:
+    """Like run_cmd() but calls pacman directly instead of via a login shell"""
+
+    executable = os.path.join(msys2_root, 'usr', 'bin', 'pacman.exe')
+    env = clean_environ(kwargs.pop("env", os.environ.copy()))
+    env["MSYSTEM"] = "MSYS"
+    # For the hooks and install scripts, like /etc/profile with MSYS2_PATH_TYPE=minimal
+    system_root = os.environ.get("SYSTEMROOT", r"C:\Windows")
+    env["PATH"] = os.pathsep.join([
+        os.path.join(msys2_root, 'usr', 'bin'),
+        os.path.join(system_root, 'System32'),
+        system_root,
+        os.path.join(system_root, 'System32', 'Wbem'),
+    ])
+
+    check_call([executable] + [str(a) for a in args], env=env, **kwargs)
+
+
+def make_tree_writable(topdir: PathLike) -> None:
+    # Ensure all files and directories under topdir are writable
+    # (and readable) by owner.
+    # Taken from meson
+    for d, _, files in os.walk(topdir):
+        os.chmod(d, os.stat(d).st_mode | stat.S_IWRITE | stat.S_IREAD)
+        for fname in files:
+            fpath = os.path.join(d, fname)
+            if os.path.isfile(fpath):
+                os.chmod(fpath, os.stat(fpath).st_mode | stat.S_IWRITE | stat.S_IREAD)
+
+
 def reset_git_repo(path: PathLike):
 
     def clean():
@@ -129,17 +161,6 @@ def reset_git_repo(path: PathLike):
         check_call(["git", "clean", "-xfdf"], cwd=path)
         check_call(["git", "reset", "--hard", "HEAD"], cwd=path)
 
-    def make_tree_writable(topdir: PathLike) -> None:
-        # Ensure all files and directories under topdir are writable
-        # (and readable) by owner.
-        # Taken from meson
-        for d, _, files in os.walk(topdir):
-            os.chmod(d, os.stat(d).st_mode | stat.S_IWRITE | stat.S_IREAD)
-            for fname in files:
-                fpath = os.path.join(d, fname)
-                if os.path.isfile(fpath):
-                    os.chmod(fpath, os.stat(fpath).st_mode | stat.S_IWRITE | stat.S_IREAD)
-
     made_writable = False
     for i in range(10):
         try:
@@ -161,15 +182,72 @@ def reset_git_repo(path: PathLike):
         clean()
 
 
+def get_git_cache_dir() -> Path:
+    return Path(os.environ.get(
+        "MSYS2_AUTOBUILD_CACHE", Path.home() / ".msys2-autobuild" / "git"))
+
+
 @contextmanager
-def fresh_git_repo(url: str, path: PathLike) -> Generator:
-    if not os.path.exists(path):
-        check_call(["git", "clone", url, path])
-        check_call(["git", "config", "core.longpaths", "true"], cwd=path)
-    else:
-        reset_git_repo(path)
-        check_call(["git", "fetch", "origin"], cwd=path)
-        check_call(["git", "reset", "--hard", "origin/master"], cwd=path)
+def updated_git_mirror(url: str) -> Generator[Path, None, None]:
+    """Gives the path to an up-to-date bare mirror of the repo at url, which is
+    kept around between runs, so only new objects have to be fetched.
+
+    The mirror is locked against other processes while in use.
+    """
+
+    cache_dir = get_git_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    mirror = cache_dir / (sha256(url.encode("utf-8")).hexdigest() + ".git")
+    with file_lock(mirror.with_suffix(".lock")):
+        if not os.path.exists(mirror):
+            # Clone next to it first, so an interrupted clone doesn't leave a broken mirror behind
+            temp_mirror = mirror.with_suffix(".tmp")
+            if os.path.exists(temp_mirror):
+                make_tree_writable(temp_mirror)
+                shutil.rmtree(temp_mirror)
+            check_call(["git", "clone", "--bare", url, temp_mirror])
+            check_call(["git", "config", "core.longpaths", "true"], cwd=temp_mirror)
+            os.rename(temp_mirror, mirror)
+        else:
+            check_call(["git", "fetch", "--prune", "origin", "+refs/heads/*:refs/heads/*"], cwd=mirror)
+        yield mirror
+
+
+def git_alternates_exist(path: PathLike) -> bool:
+    """If all the object directories a git checkout borrows from still exist"""
+
+    alternates = os.path.join(path, ".git", "objects", "info", "alternates")
+    if not os.path.exists(alternates):
+        return True
+    with open(alternates, "r", encoding="utf-8") as h:
+        return all(os.path.isdir(line.strip()) for line in h if line.strip())
+
+
+@contextmanager
+def fresh_git_repo(url: str, path: PathLike, sparse_dir: str) -> Generator:
+    """Gives an up-to-date checkout of the repo at url, with only the top level
+    files and sparse_dir checked out.
+    """
+
+    with updated_git_mirror(url) as mirror:
+        # The checkout borrows the objects from the mirror, so if the mirror is
+        # gone (cache cleared, or a different cache dir) it is broken
+        if os.path.exists(path) and not git_alternates_exist(path):
+            print(f"Mirror used by {path} is gone, cloning again")
+            make_tree_writable(path)
+            shutil.rmtree(path)
+
+        if not os.path.exists(path):
+            check_call(["git", "clone", "--no-checkout", "--reference", mirror, url, path])
+            check_call(["git", "config", "core.longpaths", "true"], cwd=path)
+            check_call(["git", "sparse-checkout", "set", "--cone", sparse_dir], cwd=path)
+            check_call(["git", "checkout", "master"], cwd=path)
+        else:
+            reset_git_repo(path)
+            check_call(["git", "sparse-checkout", "set", "--cone", sparse_dir], cwd=path)
+            # The mirror was just updated, so fetch from there instead of the network
+            check_call(["git", "fetch", mirror, "+refs/heads/master:refs/remotes/origin/master"], cwd=path)
+            check_call(["git", "reset", "--hard", "origin/master"], cwd=path)
     try:
         yield
     finally:
@@ -180,72 +258,70 @@ def fresh_git_repo(url: str, path: PathLike) -> Generator:
 @contextmanager
 def staging_dependencies(
         build_type: BuildType, pkg: Package, msys2_root: PathLike,
-        builddir: PathLike) -> Generator[PathLike, None, None]:
-
-    def add_to_repo(repo_root: PathLike, pacman_config: PathLike, repo_name: str,
-                    assets: List[GitReleaseAsset]) -> None:
-        repo_dir = Path(repo_root) / repo_name
-        os.makedirs(repo_dir, exist_ok=True)
+        builddir: PathLike, cached_assets: CachedAssets) -> Generator[PathLike, None, None]:
 
-        todo = []
-        for asset in assets:
-            asset_path = os.path.join(repo_dir, get_asset_filename(asset))
-            todo.append((asset_path, asset))
+    def add_to_repo(repo_root: PathLike, repo_name: str, package_paths: List[str]) -> str:
+        """Creates the repo DB and returns the pacman config section for it"""
 
-        def fetch_item(item: Tuple[str, GitReleaseAsset]) -> Tuple[str, GitReleaseAsset]:
-            asset_path, asset = item
-            download_asset(asset, asset_path)
-            return item
-
-        package_paths = []
-        with ThreadPoolExecutor(8) as executor:
-            for i, item in enumerate(executor.map(fetch_item, todo)):
-                asset_path, asset = item
-                print(f"[{i + 1}/{len(todo)}] {get_asset_filename(asset)}")
-                package_paths.append(asset_path)
+        repo_dir = Path(repo_root) / repo_name
 
         repo_name = f"autobuild-{repo_name}"
         repo_db_path = os.path.join(repo_dir, f"{repo_name}.db.tar.gz")
 
-        with open(pacman_config, "r", encoding="utf-8") as h:
-            text = h.read()
-            uri = to_pure_posix_path(repo_dir).as_uri()
-            if uri not in text:
-                with open(pacman_config, "w", encoding="utf-8") as h2:
-                    h2.write(f"""[{repo_name}]
-Server={uri}
-SigLevel=Never
-""")
-                    h2.write(text)
-
-        # repo-add 15 packages at a time so we don't hit the size limit for CLI arguments
-        ChunkItem = TypeVar("ChunkItem")
-
-        def chunks(lst: List[ChunkItem], n: int) -> Generator[List[ChunkItem], None, None]:
-            for i in range(0, len(lst), n):
-                yield lst[i:i + n]
+        # repo-add as many packages at a time as possible, every call rewrites the
+        # whole DB. But stay well below the size limit for the Windows command
+        # line (32767 characters).
+        def chunks(lst: List[PathLike], max_length: int) -> Generator[List[PathLike], None, None]:
+            chunk: List[PathLike] = []
+            length = 0
+            for item in lst:
+                item_length = len(str(item)) + 3
+                if chunk and length + item_length > max_length:
+                    yield chunk
+                    chunk = []
+                    length = 0
+                chunk.append(item)
+                length += item_length
+            if chunk:
+                yield chunk
 
         base_args: List[PathLike] = ["repo-add", to_pure_posix_path(repo_db_path)]
         posix_paths: List[PathLike] = [to_pure_posix_path(p) for p in package_paths]
-        for chunk in chunks(posix_paths, 15):
+        for chunk in chunks(posix_paths, 16000):
             args = base_args + chunk
             run_cmd(msys2_root, args, cwd=repo_dir)
 
-    cached_assets = CachedAssets()
+        uri = to_pure_posix_path(repo_dir).as_uri()
+        return f"""[{repo_name}]
+Server={uri}
+SigLevel=Never
+"""
+
+    # The downloaded packages are kept between builds, so dependencies shared
+    # by multiple packages in the queue only have to be downloaded once.
     repo_root = os.path.join(builddir, "_REPO")
-    try:
+    if os.path.exists(repo_root) and \
+            shutil.disk_usage(repo_root).free < Config.STAGING_CACHE_MIN_FREE_SPACE:
         shutil.rmtree(repo_root, ignore_errors=True)
-        os.makedirs(repo_root, exist_ok=True)
+    os.makedirs(repo_root, exist_ok=True)
+    # The repo DBs on the other hand only contain the packages of the current build
+    for pattern in ["autobuild-*.db*", "autobuild-*.files*"]:
+        for path in glob.glob(os.path.join(repo_root, "*", pattern)):
+            os.remove(path)
+
+    # Without any staging dependencies there is nothing to up/downgrade
+    did_stage = False
+    try:
         with temp_pacman_conf(msys2_root) as pacman_config:
             to_add: Dict[ArchType, List[GitReleaseAsset]] = {}
             for dep_type, deps in pkg.get_depends(build_type).items():
-                assets = cached_assets.get_assets(dep_type)
+                assets_by_name = {get_asset_filename(a): a for a in cached_assets.get_assets(dep_type)}
+                filenames = PackageFilenames(assets_by_name.keys())
                 for dep in deps:
                     for pattern in dep.get_build_patterns(dep_type):
-                        for asset in assets:
-                            if fnmatch.fnmatch(get_asset_filename(asset), pattern):
-                                to_add.setdefault(dep_type, []).append(asset)
-                                break
+                        matches = filenames.filter(pattern)
+                        if matches:
+                            to_add.setdefault(dep_type, []).append(assets_by_name[matches[0]])
                         else:
                             if pkg.is_optional_dep(dep, dep_type):
                                 # If it's there, good, if not we ignore it since it's part of a cycle
@@ -253,22 +329,81 @@ SigLevel=Never
                             else:
                                 raise SystemExit(f"asset for {pattern} in {dep_type} not found")
 
+            todo = []
             for dep_type, assets in to_add.items():
-                add_to_repo(repo_root, pacman_config, dep_type, assets)
+                repo_dir = Path(repo_root) / dep_type
+                os.makedirs(repo_dir, exist_ok=True)
+                for asset in assets:
+                    todo.append((dep_type, str(repo_dir / get_asset_filename(asset)), asset))
+
+            def fetch_item(
+                    item: Tuple[ArchType, str, GitReleaseAsset]) -> Tuple[ArchType, str, GitReleaseAsset]:
+                dep_type, asset_path, asset = item
+                if not asset_file_is_uptodate(asset_path, asset):
+                    download_asset(asset, asset_path)
+                return item
+
+            # Download the packages of all repos in one go, and only then register
+            # them, since that modifies the shared pacman config.
+            package_paths: Dict[ArchType, List[str]] = {}
+            with ThreadPoolExecutor(8) as executor:
+                for i, item in enumerate(executor.map(fetch_item, todo)):
+                    dep_type, asset_path, asset = item
+                    print(f"[{i + 1}/{len(todo)}] {get_asset_filename(asset)}")
+                    package_paths.setdefault(dep_type, []).append(asset_path)
+
+            did_stage = bool(package_paths)
+            sections = []
+            for dep_type, paths in package_paths.items():
+                sections.append(add_to_repo(repo_root, dep_type, paths))
+
+            if sections:
+                # The repos have to come first, so they take priority
+                with open(pacman_config, "r", encoding="utf-8") as h:
+                    text = h.read()
+                with open(pacman_config, "w", encoding="utf-8") as h:
+                    h.write("".join(sections))
+                    h.write(text)
 
             with temp_pacman_script(pacman_config) as temp_pacman:
-                # in case they are already installed we need to upgrade
-                run_cmd(msys2_root, [to_pure_posix_path(temp_pacman), "--noconfirm", "-Suy"])
-                run_cmd(msys2_root, [to_pure_posix_path(temp_pacman), "--noconfirm", "-Su"])
+                if did_stage:
+                    # in case they are already installed we need to upgrade
+                    config_args = ["--config", to_pure_posix_path(pacman_config)]
+                    run_pacman(msys2_root, config_args + ["--noconfirm", "-Suy"])
+                    run_pacman(msys2_root, config_args + ["--noconfirm", "-Su"])
                 yield temp_pacman
     finally:
-        shutil.rmtree(repo_root, ignore_errors=True)
-        # downgrade again
-        run_cmd(msys2_root, ["pacman", "--noconfirm", "-Suuy"])
-        run_cmd(msys2_root, ["pacman", "--noconfirm", "-Suu"])
+        if did_stage:
+            # downgrade again
+            run_pacman(msys2_root, ["--noconfirm", "-Suuy"])
+            run_pacman(msys2_root, ["--noconfirm", "-Suu"])
+
+
+def get_uploads_dir(builddir: PathLike) -> str:
+    return os.path.join(builddir, "_UPLOADS")
+
+
+def upload_packages(build_type: BuildType, upload_dir: PathLike, paths: List[str], title: str) -> None:
+    # This runs in the background while the next package is built, so prefix
+    # the output to make clear which build it belongs to
+    def log(message: str) -> None:
+        print(f"{title}: {message}")
+
+    try:
+        wait_for_api_limit_reset(log=log)
+        release = get_repo(build_type).get_release("staging-" + build_type)
+        for path in paths:
+            upload_asset(release, path, log=log)
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
 
+def build_package(build_type: BuildType, pkg: Package, msys2_root: PathLike, builddir: PathLike,
+                  cached_assets: CachedAssets, upload_executor: Executor) -> "Future[None]":
+    """Builds the package and returns a future for the upload of the results,
+    which happens in the background using upload_executor.
+    """
 
-def build_package(build_type: BuildType, pkg: Package, msys2_root: PathLike, builddir: PathLike) -> None:
     assert os.path.isabs(builddir)
     assert os.path.isabs(msys2_root)
     os.makedirs(builddir, exist_ok=True)
@@ -276,10 +411,11 @@ def build_package(build_type: BuildType, pkg: Package, msys2_root: PathLike, bui
     repo_name = {"MINGW-packages": "M", "MSYS2-packages": "S"}.get(pkg['repo'], pkg['repo'])
     repo_dir = os.path.join(builddir, repo_name)
     to_upload: List[str] = []
+    upload_paths: List[str] = []
 
     repo = get_repo(build_type)
 
-    with fresh_git_repo(pkg['repo_url'], repo_dir):
+    with fresh_git_repo(pkg['repo_url'], repo_dir, pkg['repo_path']):
         orig_pkg_dir = os.path.join(repo_dir, pkg['repo_path'])
         # Rename it to get a shorter overall build path
         # https://github.com/msys2/msys2-autobuild/issues/71
@@ -291,7 +427,8 @@ def build_package(build_type: BuildType, pkg: Package, msys2_root: PathLike, bui
         validpgpkeys = to_pure_posix_path(os.path.join(SCRIPT_DIR, 'fetch-validpgpkeys.sh'))
         run_cmd(msys2_root, ['bash', validpgpkeys], cwd=pkg_dir)
 
-        with staging_dependencies(build_type, pkg, msys2_root, builddir) as temp_pacman:
+        with staging_dependencies(
+                build_type, pkg, msys2_root, builddir, cached_assets) as temp_pacman:
             try:
                 env = get_build_environ(build_type)
                 # this makes makepkg use our custom pacman script
@@ -335,7 +472,8 @@ def build_package(build_type: BuildType, pkg: Package, msys2_root: PathLike, bui
                 else:
                     assert 0
 
-                entries = os.listdir(pkg_dir)
+                with os.scandir(pkg_dir) as it:
+                    entries = [e.name for e in it if e.is_file()]
                 for pattern in pkg.get_build_patterns(build_type):
                     found = fnmatch.filter(entries, pattern)
                     if not found:
@@ -354,7 +492,15 @@ def build_package(build_type: BuildType, pkg: Package, msys2_root: PathLike, bui
 
                 raise BuildError(e)
             else:
-                wait_for_api_limit_reset()
-                release = repo.get_release("staging-" + build_type)
+                # Move the results out of the git checkout, since that gets
+                # cleaned up before the upload is done
+                uploads_root = get_uploads_dir(builddir)
+                os.makedirs(uploads_root, exist_ok=True)
+                upload_dir = tempfile.mkdtemp(dir=uploads_root)
                 for path in to_upload:
-                    upload_asset(release, path)
+                    upload_path = os.path.join(upload_dir, os.path.basename(path))
+                    shutil.move(path, upload_path)
+                    upload_paths.append(upload_path)
+
+    title = f"[{pkg['repo']}] [{build_type}] {pkg['name']}"
+    return upload_executor.submit(upload_packages, build_type, upload_dir, upload_paths, title)
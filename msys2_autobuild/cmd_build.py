@@ -3,11 +3,13 @@ import shutil
 import sys
 import time
 import traceback
-from typing import Any, List, Literal, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Collection, Dict, List, Literal, Optional, Tuple
 
-from .build import BuildError, build_package, run_cmd
+from .build import BuildError, build_package, get_uploads_dir, run_cmd
 from .config import BuildType, Config
-from .gh import wait_for_api_limit_reset
+from .gh import CachedAssets, wait_for_api_limit_reset
 from .queue import (Package, PackageStatus, get_buildqueue_with_status,
                     update_status)
 from .utils import apply_optional_deps, gha_group
@@ -17,13 +19,16 @@ BuildFrom = Literal["start", "middle", "end"]
 
 def get_package_to_build(
         pkgs: List[Package], build_types: Optional[List[BuildType]],
-        build_from: BuildFrom) -> Optional[Tuple[Package, BuildType]]:
+        build_from: BuildFrom,
+        skip: Collection[Tuple[str, BuildType]] = ()) -> Optional[Tuple[Package, BuildType]]:
 
     can_build = []
     for pkg in pkgs:
         for build_type in pkg.get_build_types():
             if build_types is not None and build_type not in build_types:
                 continue
+            if (pkg["name"], build_type) in skip:
+                continue
             if pkg.get_status(build_type) == PackageStatus.WAITING_FOR_BUILD:
                 can_build.append((pkg, build_type))
 
@@ -68,28 +73,80 @@ def run_build(args: Any) -> None:
 
     print(f"Building {build_types} starting from {args.build_from}")
 
-    while True:
-        wait_for_api_limit_reset()
-
-        pkgs = get_buildqueue_with_status(full_details=True)
-        update_status(pkgs)
-
-        if (time.monotonic() - start_time) >= Config.SOFT_JOB_TIMEOUT:
-            print("timeout reached")
-            break
-
-        todo = get_package_to_build(pkgs, build_types, args.build_from)
-        if not todo:
-            break
-        pkg, build_type = todo
+    # The results of a build get uploaded in the background while the next
+    # package is built. Until the upload is done the package still looks
+    # unbuilt, so we skip it and its dependents wait for it.
+    pending_uploads: Dict[Tuple[str, BuildType], "Future[None]"] = {}
+
+    def check_uploads(block: bool = False) -> None:
+        deadline = time.monotonic() + Config.UPLOAD_TIMEOUT
+        for key, future in list(pending_uploads.items()):
+            if block or future.done():
+                del pending_uploads[key]
+                try:
+                    # raises in case the upload failed
+                    future.result(timeout=max(0, deadline - time.monotonic()))
+                except FutureTimeoutError:
+                    name, build_type = key
+                    raise SystemExit(
+                        f"ERROR: uploads didn't finish within {Config.UPLOAD_TIMEOUT} "
+                        f"seconds, stuck at {name} ({build_type})")
+
+    def drain_uploads() -> None:
+        # Builds which succeeded before the error should still get uploaded
+        done, _ = wait(pending_uploads.values(), timeout=Config.UPLOAD_TIMEOUT)
+        for (name, build_type), future in pending_uploads.items():
+            if future not in done:
+                print(f"upload for {name} ({build_type}) didn't finish in time")
+            elif future.exception() is not None:
+                print(f"upload for {name} ({build_type}) failed: {future.exception()}")
+
+    # Results of a previous run which didn't get uploaded
+    shutil.rmtree(get_uploads_dir(builddir), ignore_errors=True)
+
+    # A single worker, so the uploads happen one at a time like before
+    upload_executor = ThreadPoolExecutor(1)
+    try:
+        while True:
+            check_uploads()
+            wait_for_api_limit_reset()
+
+            # Share the release assets between the status and the build, so they
+            # are only fetched once per iteration
+            cached_assets = CachedAssets()
+            pkgs = get_buildqueue_with_status(full_details=True, cached_assets=cached_assets)
+            update_status(pkgs)
+
+            if (time.monotonic() - start_time) >= Config.SOFT_JOB_TIMEOUT:
+                print("timeout reached")
+                break
+
+            todo = get_package_to_build(pkgs, build_types, args.build_from, pending_uploads)
+            if not todo:
+                if pending_uploads:
+                    # The uploads might unblock other packages
+                    check_uploads(block=True)
+                    continue
+                break
+            pkg, build_type = todo
+
+            try:
+                with gha_group(f"[{pkg['repo']}] [{build_type}] {pkg['name']}..."):
+                    pending_uploads[(pkg["name"], build_type)] = build_package(
+                        build_type, pkg, msys2_root, builddir, cached_assets, upload_executor)
+            except BuildError:
+                with gha_group(f"[{pkg['repo']}] [{build_type}] {pkg['name']}: failed"):
+                    traceback.print_exc(file=sys.stdout)
+                continue
 
-        try:
-            with gha_group(f"[{pkg['repo']}] [{build_type}] {pkg['name']}..."):
-                build_package(build_type, pkg, msys2_root, builddir)
-        except BuildError:
-            with gha_group(f"[{pkg['repo']}] [{build_type}] {pkg['name']}: failed"):
-                traceback.print_exc(file=sys.stdout)
-            continue
+        check_uploads(block=True)
+    except Exception:
+        drain_uploads()
+        raise
+    finally:
+        # Note that a still running upload is waited for on interpreter exit
+        # anyway, a stuck connection is only bounded by REQUESTS_TIMEOUT
+        upload_executor.shutdown(wait=False)
 
 
 def add_parser(subparsers: Any) -> None:
@@ -1,17 +1,18 @@
-import fnmatch
+import argparse
 import os
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Any, Dict, List, Tuple
 import subprocess
 
 from github.GitReleaseAsset import GitReleaseAsset
 
-from .config import BuildType, Config
-from .gh import (CachedAssets, download_asset, get_asset_filename,
-                 get_asset_mtime_ns, is_asset_from_gha, get_asset_uploader_name)
+from .config import REQUESTS_POOL_SIZE, BuildType, Config
+from .gh import (CachedAssets, asset_file_is_uptodate, download_asset,
+                 get_asset_filename, get_asset_part_path, is_asset_from_gha,
+                 get_asset_uploader_name)
 from .queue import PackageStatus, get_buildqueue_with_status
-from .utils import ask_yes_no
+from .utils import PackageFilenames, ask_yes_no
 
 
 def get_repo_subdir(build_type: BuildType) -> Path:
@@ -34,7 +35,8 @@ def fetch_assets(args: Any) -> None:
 
     all_patterns: Dict[BuildType, List[str]] = {}
     all_blocked = []
-    for pkg in get_buildqueue_with_status():
+    cached_assets = CachedAssets()
+    for pkg in get_buildqueue_with_status(cached_assets=cached_assets):
         for build_type in pkg.get_build_types():
             if args.build_type and build_type not in args.build_type:
                 continue
@@ -51,7 +53,6 @@ def fetch_assets(args: Any) -> None:
                         (pkg["name"], build_type, pkg.get_status_details(build_type)))
 
     all_assets = {}
-    cached_assets = CachedAssets()
     assets_to_download: Dict[BuildType, List[GitReleaseAsset]] = {}
     for build_type, patterns in all_patterns.items():
         if build_type not in all_assets:
@@ -62,8 +63,9 @@ def fetch_assets(args: Any) -> None:
         for asset in assets:
             assets_mapping.setdefault(get_asset_filename(asset), []).append(asset)
 
+        filenames = PackageFilenames(assets_mapping.keys())
         for pattern in patterns:
-            matches = fnmatch.filter(assets_mapping.keys(), pattern)
+            matches = filenames.filter(pattern)
             if matches:
                 found = assets_mapping[matches[0]]
                 assets_to_download.setdefault(build_type, []).extend(found)
@@ -82,15 +84,8 @@ def fetch_assets(args: Any) -> None:
                                   f"from {get_asset_uploader_name(asset)!r}, continue?"):
                     raise SystemExit("aborting")
 
-    def file_is_uptodate(path: str, asset: GitReleaseAsset) -> bool:
-        asset_path = Path(path)
-        if not asset_path.exists():
-            return False
-        if asset_path.stat().st_size != asset.size:
-            return False
-        if get_asset_mtime_ns(asset) != asset_path.stat().st_mtime_ns:
-            return False
-        return True
+    # partial downloads we can resume
+    part_paths = {get_asset_part_path(asset, path) for path, asset in to_fetch.items()}
 
     # find files that are either wrong or not what we want
     to_delete = []
@@ -98,9 +93,11 @@ def fetch_assets(args: Any) -> None:
     for root, dirs, files in os.walk(target_dir):
         for name in files:
             existing = os.path.join(root, name)
-            if existing in to_fetch:
+            if existing in part_paths:
+                continue
+            elif existing in to_fetch:
                 asset = to_fetch[existing]
-                if not file_is_uptodate(existing, asset):
+                if not asset_file_is_uptodate(existing, asset):
                     to_delete.append(existing)
                     not_uptodate.append(existing)
             else:
@@ -153,13 +150,24 @@ def fetch_assets(args: Any) -> None:
             download_asset(asset, asset_path, verify_file)
         return item
 
-    with ThreadPoolExecutor(8) as executor:
-        for i, item in enumerate(executor.map(fetch_item, todo.items())):
+    with ThreadPoolExecutor(args.jobs) as executor:
+        futures = [executor.submit(fetch_item, item) for item in todo.items()]
+        for i, future in enumerate(as_completed(futures)):
+            item = future.result()
             print(f"[{i + 1}/{len(todo)}] {get_asset_filename(item[1])}")
 
     print("done")
 
 
+def jobs_count(value: str) -> int:
+    # More jobs than pooled connections would just wait for a free connection
+    number = int(value)
+    if not 1 <= number <= REQUESTS_POOL_SIZE:
+        raise argparse.ArgumentTypeError(
+            f"must be between 1 and {REQUESTS_POOL_SIZE}, got {value}")
+    return number
+
+
 def add_parser(subparsers: Any) -> None:
     sub = subparsers.add_parser(
         "fetch-assets", help="Download all staging packages", allow_abbrev=False)
@@ -182,4 +190,7 @@ def add_parser(subparsers: Any) -> None:
     sub.add_argument(
         "--noconfirm", action="store_true",
         help="Don't require user confirmation")
+    sub.add_argument(
+        "-j", "--jobs", type=jobs_count, default=REQUESTS_POOL_SIZE,
+        help="Number of parallel downloads (default: %(default)s)")
     sub.set_defaults(func=fetch_assets)
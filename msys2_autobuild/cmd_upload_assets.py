@@ -1,7 +1,10 @@
 import glob
 import os
-from typing import Any
+from typing import Any, Dict
 
+from github.GitRelease import GitRelease
+
+from .config import BuildType
 from .gh import get_release, get_repo, upload_asset
 from .queue import PackageStatus, get_buildqueue_with_status
 
@@ -45,9 +48,12 @@ def upload_assets(args: Any) -> None:
                 matches.append((build_type, match))
     print(f"Found {len(matches)} files..")
 
+    releases: Dict[BuildType, GitRelease] = {}
     for build_type, match in matches:
-        repo = get_repo(build_type)
-        release = get_release(repo, 'staging-' + build_type)
+        if build_type not in releases:
+            repo = get_repo(build_type)
+            releases[build_type] = get_release(repo, 'staging-' + build_type)
+        release = releases[build_type]
         print(f"Uploading {match}")
         if not args.dry_run:
             upload_asset(release, match)
@@ -9,6 +9,9 @@ BuildType = Union[ArchType, SourceType]
 
 REQUESTS_TIMEOUT = (15, 30)
 REQUESTS_RETRY = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502])
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Connections kept alive per host, the upper limit for parallel downloads
+REQUESTS_POOL_SIZE = 16
 
 
 def get_all_build_types() -> List[BuildType]:
@@ -63,6 +66,12 @@ class Config:
     SOFT_JOB_TIMEOUT = 60 * 60 * 3
     """Runtime after which we shouldn't start a new build"""
 
+    STAGING_CACHE_MIN_FREE_SPACE = 10 * 1024 ** 3
+    """Clear the downloaded staging dependencies of previous builds if less disk space is left"""
+
+    UPLOAD_TIMEOUT = 60 * 30
+    """Maximum time to wait for all pending background uploads to finish"""
+
     MAXIMUM_JOB_COUNT = 15
     """Maximum number of jobs to spawn"""
 
@@ -2,14 +2,14 @@ import io
 import os
 import shutil
 import sys
-import tempfile
+import threading
 import time
 from contextlib import contextmanager
 from datetime import datetime, timezone
-from functools import lru_cache
+from functools import wraps
 from hashlib import sha256
 from pathlib import Path
-from typing import Any, Dict, Generator, List, Optional, Callable
+from typing import Any, Dict, Generator, List, Optional, Callable, TypeVar, cast
 
 import requests
 from github import Github
@@ -20,7 +20,7 @@ from github.GitRelease import GitRelease
 from github.GitReleaseAsset import GitReleaseAsset
 from github.Repository import Repository
 
-from .config import REQUESTS_TIMEOUT, BuildType, Config
+from .config import DOWNLOAD_CHUNK_SIZE, REQUESTS_TIMEOUT, BuildType, Config
 from .utils import PathLike, get_requests_session
 
 
@@ -38,6 +38,29 @@ def get_auth(write: bool = False) -> Optional[Auth]:
             raise Exception("'GITHUB_TOKEN' env var not set")
 
 
+_thread_local = threading.local()
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def thread_cache(func: F) -> F:
+    """Like lru_cache(maxsize=None), but with a separate cache for each thread.
+
+    PyGithub clients can't be used from multiple threads at once, since
+    concurrent requests can mix up their state, so each thread gets its own.
+    """
+
+    @wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        cache = _thread_local.__dict__.setdefault(func.__qualname__, {})
+        key = (args, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = func(*args, **kwargs)
+        return cache[key]
+
+    return cast(F, wrapper)
+
+
 @contextmanager
 def make_writable(obj: GithubObject) -> Generator:
     # XXX: This switches the read-only token with a potentially writable one
@@ -50,20 +73,20 @@ def make_writable(obj: GithubObject) -> Generator:
         obj._requester = old_requester  # type: ignore
 
 
-@lru_cache(maxsize=None)
+@thread_cache
 def get_current_repo(write: bool = False) -> Repository:
     gh = get_github(write=write)
     repo_full_name = os.environ.get("GITHUB_REPOSITORY", "msys2/msys2-autobuild")
     return gh.get_repo(repo_full_name, lazy=True)
 
 
-@lru_cache(maxsize=None)
+@thread_cache
 def get_repo(build_type: BuildType, write: bool = False) -> Repository:
     gh = get_github(write=write)
     return gh.get_repo(Config.ASSETS_REPO[build_type], lazy=True)
 
 
-@lru_cache(maxsize=None)
+@thread_cache
 def get_github(write: bool = False) -> Github:
     auth = get_auth(write=write)
     kwargs: Dict[str, Any] = {}
@@ -113,7 +136,7 @@ def get_current_run_urls() -> Optional[Dict[str, str]]:
 
 def wait_for_api_limit_reset(
         min_remaining_write: int = 50, min_remaining: int = 250, min_sleep: float = 60,
-        max_sleep: float = 300) -> None:
+        max_sleep: float = 300, log: Callable[[str], None] = print) -> None:
 
     for write in [False, True]:
         gh = get_github(write=write)
@@ -122,8 +145,8 @@ def wait_for_api_limit_reset(
             reset = core.reset
             now = datetime.now(timezone.utc)
             diff = (reset - now).total_seconds()
-            print(f"{core.remaining} API calls left (write={write}), "
-                  f"{diff} seconds until the next reset")
+            log(f"{core.remaining} API calls left (write={write}), "
+                f"{diff} seconds until the next reset")
             if core.remaining > (min_remaining_write if write else min_remaining):
                 break
             wait = diff
@@ -131,7 +154,7 @@ def wait_for_api_limit_reset(
                 wait = min_sleep
             elif wait > max_sleep:
                 wait = max_sleep
-            print(f"Too few API calls left, waiting for {wait} seconds")
+            log(f"Too few API calls left, waiting for {wait} seconds")
             time.sleep(wait)
 
 
@@ -141,28 +164,66 @@ def get_asset_mtime_ns(asset: GitReleaseAsset) -> int:
     return int(asset.updated_at.timestamp() * (1000 ** 3))
 
 
+def asset_file_is_uptodate(path: PathLike, asset: GitReleaseAsset) -> bool:
+    """If path is an already downloaded copy of asset"""
+
+    asset_path = Path(path)
+    if not asset_path.exists():
+        return False
+    if asset_path.stat().st_size != asset.size:
+        return False
+    if get_asset_mtime_ns(asset) != asset_path.stat().st_mtime_ns:
+        return False
+    return True
+
+
+def get_asset_part_path(asset: GitReleaseAsset, target_path: str) -> str:
+    """Returns the path of the partial download of asset to target_path"""
+
+    return f"{target_path}.{asset.id}.part"
+
+
 def download_asset(asset: GitReleaseAsset, target_path: str,
                    onverify: Callable[[str, str], None] | None = None) -> None:
     assert asset_is_complete(asset)
     session = get_requests_session(nocache=True)
-    with session.get(asset.browser_download_url, stream=True, timeout=REQUESTS_TIMEOUT) as r:
+
+    # Interrupted downloads are kept next to the target and resumed on the next
+    # try. The ID changes if the asset gets replaced, so we never resume that.
+    temppath = get_asset_part_path(asset, target_path)
+    offset = os.path.getsize(temppath) if os.path.exists(temppath) else 0
+    headers = {}
+    if 0 < offset < asset.size:
+        headers["Range"] = f"bytes={offset}-"
+
+    with session.get(asset.browser_download_url, stream=True, timeout=REQUESTS_TIMEOUT,
+                     headers=headers) as r:
         r.raise_for_status()
-        fd, temppath = tempfile.mkstemp()
+        # In case the range wasn't requested or the server ignored it we start over
+        append = r.status_code == 206
+        with open(temppath, "ab" if append else "wb") as h:
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, h, DOWNLOAD_CHUNK_SIZE)
+            size = h.tell()
+
+    if size != asset.size:
+        if size > asset.size:
+            os.remove(temppath)
+        raise requests.RequestException(
+            f"Downloaded {size} bytes for {get_asset_filename(asset)}, expected {asset.size}")
+
+    try:
+        os.chmod(temppath, 0o644)
+        mtime_ns = get_asset_mtime_ns(asset)
+        os.utime(temppath, ns=(mtime_ns, mtime_ns))
+        if onverify is not None:
+            onverify(temppath, target_path)
+        shutil.move(temppath, target_path)
+    finally:
         try:
-            os.chmod(temppath, 0o644)
-            with os.fdopen(fd, "wb") as h:
-                for chunk in r.iter_content(4096):
-                    h.write(chunk)
-            mtime_ns = get_asset_mtime_ns(asset)
-            os.utime(temppath, ns=(mtime_ns, mtime_ns))
-            if onverify is not None:
-                onverify(temppath, target_path)
-            shutil.move(temppath, target_path)
-        finally:
-            try:
-                os.remove(temppath)
-            except OSError:
-                pass
+            os.remove(temppath)
+        except OSError:
+            pass
 
 
 def get_gh_asset_name(basename: PathLike, text: bool = False) -> str:
@@ -217,7 +278,8 @@ def get_release_assets(release: GitRelease, include_incomplete: bool = False) ->
 
 
 def upload_asset(release: GitRelease, path: PathLike, replace: bool = False,
-                 text: bool = False, content: Optional[bytes] = None) -> None:
+                 text: bool = False, content: Optional[bytes] = None,
+                 log: Callable[[str], None] = print) -> None:
     path = Path(path)
     basename = os.path.basename(str(path))
     asset_name = get_gh_asset_name(basename, text)
@@ -233,7 +295,7 @@ def upload_asset(release: GitRelease, path: PathLike, replace: bool = False,
                         asset.delete_asset()
                     break
                 else:
-                    print(f"Skipping upload for {asset_name} as {asset_label}, already exists")
+                    log(f"Skipping upload for {asset_name} as {asset_label}, already exists")
                     return False
         return True
 
@@ -254,7 +316,7 @@ def upload_asset(release: GitRelease, path: PathLike, replace: bool = False,
         if can_try_upload_again():
             upload()
 
-    print(f"Uploaded {asset_name} as {asset_label}")
+    log(f"Uploaded {asset_name} as {asset_label}")
 
 
 def get_release(repo: Repository, name: str, create: bool = True) -> GitRelease:
@@ -272,13 +334,25 @@ def get_release(repo: Repository, name: str, create: bool = True) -> GitRelease:
 class CachedAssets:
 
     def __init__(self) -> None:
+        self._releases: Dict[str, Dict[str, GitRelease]] = {}
         self._assets: Dict[BuildType, List[GitReleaseAsset]] = {}
         self._failed: Dict[str, List[GitReleaseAsset]] = {}
 
+    def _get_release(self, repo: Repository, name: str) -> GitRelease:
+        key = repo.full_name
+        if key not in self._releases:
+            # Listing the releases includes their assets, so this gives us all
+            # staging releases with one request, instead of one per release.
+            self._releases[key] = {r.tag_name: r for r in repo.get_releases()}
+        releases = self._releases[key]
+        if name not in releases:
+            releases[name] = get_release(repo, name)
+        return releases[name]
+
     def get_assets(self, build_type: BuildType) -> List[GitReleaseAsset]:
         if build_type not in self._assets:
             repo = get_repo(build_type)
-            release = get_release(repo, 'staging-' + build_type)
+            release = self._get_release(repo, 'staging-' + build_type)
             self._assets[build_type] = get_release_assets(release)
         return self._assets[build_type]
 
@@ -286,7 +360,7 @@ class CachedAssets:
         repo = get_repo(build_type)
         key = repo.full_name
         if key not in self._failed:
-            release = get_release(repo, 'staging-failed')
+            release = self._get_release(repo, 'staging-failed')
             self._failed[key] = get_release_assets(release)
         assets = self._failed[key]
         # XXX: This depends on the format of the filename
@@ -13,7 +13,8 @@ from .config import (REQUESTS_TIMEOUT, ArchType, BuildType, Config,
 from .gh import (CachedAssets, download_text_asset, get_asset_filename,
                  get_current_repo, get_release, make_writable,
                  asset_is_complete)
-from .utils import get_requests_session, queue_website_update
+from .utils import (PackageFilenames, get_requests_session,
+                    queue_website_update)
 
 
 class PackageStatus(Enum):
@@ -163,16 +164,16 @@ def get_buildqueue() -> List[Package]:
                     ver_depends.setdefault(repo, set()).add(dep_mapping[dep])
             build['ext-depends'] = ver_depends
 
-    # reverse dependencies
+    # reverse dependencies, collected in one pass over all dependencies
+    all_r_depends: Dict[Package, Dict[str, Set[Package]]] = {pkg: {} for pkg in pkgs}
+    for pkg2 in pkgs:
+        for r_repo, build2 in pkg2._active_builds.items():
+            for deps in build2['ext-depends'].values():
+                for dep in deps:
+                    all_r_depends[dep].setdefault(r_repo, set()).add(pkg2)
     for pkg in pkgs:
         for build in pkg._active_builds.values():
-            r_depends: Dict[str, Set[Package]] = {}
-            for pkg2 in pkgs:
-                for r_repo, build2 in pkg2._active_builds.items():
-                    for repo, deps in build2['ext-depends'].items():
-                        if pkg in deps:
-                            r_depends.setdefault(r_repo, set()).add(pkg2)
-            build['ext-rdepends'] = r_depends
+            build['ext-rdepends'] = all_r_depends[pkg]
 
     return pkgs
 
@@ -208,8 +209,10 @@ def get_cycles(pkgs: List[Package]) -> Set[Tuple[Package, Package]]:
     return cycles
 
 
-def get_buildqueue_with_status(full_details: bool = False) -> List[Package]:
-    cached_assets = CachedAssets()
+def get_buildqueue_with_status(
+        full_details: bool = False, cached_assets: Optional[CachedAssets] = None) -> List[Package]:
+    if cached_assets is None:
+        cached_assets = CachedAssets()
 
     assets_failed = []
     for build_type in get_all_build_types():
@@ -225,22 +228,26 @@ def get_buildqueue_with_status(full_details: bool = False) -> List[Package]:
                 if result["urls"]:
                     failed_urls[get_asset_filename(asset)] = result["urls"]
 
+    all_done_names: Dict[BuildType, PackageFilenames] = {}
+    failed_names = {get_asset_filename(a) for a in assets_failed}
+
     def pkg_is_done(build_type: BuildType, pkg: Package) -> bool:
-        done_names = [get_asset_filename(a) for a in cached_assets.get_assets(build_type)]
+        if build_type not in all_done_names:
+            all_done_names[build_type] = PackageFilenames(
+                get_asset_filename(a) for a in cached_assets.get_assets(build_type))
+        done_names = all_done_names[build_type]
         for pattern in pkg.get_build_patterns(build_type):
-            if not fnmatch.filter(done_names, pattern):
+            if not done_names.filter(pattern):
                 return False
         return True
 
     def get_failed_urls(build_type: BuildType, pkg: Package) -> Optional[Dict[str, str]]:
-        failed_names = [get_asset_filename(a) for a in assets_failed]
         name = pkg.get_failed_name(build_type)
         if name in failed_names:
             return failed_urls.get(name)
         return None
 
     def pkg_has_failed(build_type: BuildType, pkg: Package) -> bool:
-        failed_names = [get_asset_filename(a) for a in assets_failed]
         name = pkg.get_failed_name(build_type)
         return name in failed_names
 
@@ -1,13 +1,16 @@
+import fnmatch
 import os
+import sys
 from contextlib import contextmanager
 from datetime import timedelta
 from functools import lru_cache
-from typing import Any, AnyStr, Dict, Generator, List, Union
+from typing import Any, AnyStr, Dict, Generator, Iterable, List, Union
 
 import requests
 from requests.adapters import HTTPAdapter
 
-from .config import REQUESTS_RETRY, REQUESTS_TIMEOUT, Config
+from .config import (REQUESTS_POOL_SIZE, REQUESTS_RETRY, REQUESTS_TIMEOUT,
+                     Config)
 
 PathLike = Union[os.PathLike, AnyStr]
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -20,7 +23,11 @@ def requests_cache_disabled() -> Any:
 
 @lru_cache(maxsize=None)
 def get_requests_session(nocache: bool = False) -> requests.Session:
-    adapter = HTTPAdapter(max_retries=REQUESTS_RETRY)
+    # The session is shared between the download thread pools, so make sure
+    # there are enough connections to keep alive for all of them
+    adapter = HTTPAdapter(
+        pool_connections=REQUESTS_POOL_SIZE, pool_maxsize=REQUESTS_POOL_SIZE,
+        max_retries=REQUESTS_RETRY)
     if nocache:
         with requests_cache_disabled():
             http = requests.Session()
@@ -105,6 +112,67 @@ def apply_optional_deps(optional_deps: str) -> None:
         Config.OPTIONAL_DEPS.setdefault(dep, []).extend(ignored)
 
 
+def get_package_name(filename: str) -> str:
+    """Returns the package name for a package or source package file name,
+    or for a build pattern matching them.
+    """
+
+    if ".src.tar." in filename:
+        # {name}-{pkgver}-{pkgrel}.src.tar.*
+        return filename.rsplit("-", 2)[0]
+    else:
+        # {name}-{pkgver}-{pkgrel}-{arch}.pkg.tar.*
+        return filename.rsplit("-", 3)[0]
+
+
+class PackageFilenames:
+    """A collection of package file names which can be matched against build
+    patterns without having to look at all of them.
+    """
+
+    def __init__(self, filenames: Iterable[str]) -> None:
+        self._by_name: Dict[str, List[str]] = {}
+        for filename in filenames:
+            self._by_name.setdefault(get_package_name(filename), []).append(filename)
+
+    def filter(self, pattern: str) -> List[str]:
+        """Like fnmatch.filter()"""
+
+        candidates = self._by_name.get(get_package_name(pattern), [])
+        return fnmatch.filter(candidates, pattern)
+
+
+@contextmanager
+def file_lock(path: PathLike) -> Generator:
+    """Holds an exclusive lock on path, for synchronizing with other processes.
+    The lock gets released by the OS if the process dies.
+    """
+
+    with open(path, "a+b") as h:
+        if sys.platform == "win32":
+            import msvcrt
+            h.seek(0)
+            while True:
+                try:
+                    # retries for 10 seconds before giving up
+                    msvcrt.locking(h.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                h.seek(0)
+                msvcrt.locking(h.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(h.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(h.fileno(), fcntl.LOCK_UN)
+
+
 def ask_yes_no(prompt, default_no: bool = True):
     """Ask a yes/no question via input() and return their answer."""
 
@@ -1,7 +1,117 @@
 # type: ignore
 
-from msys2_autobuild.utils import parse_optional_deps
+import io
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from msys2_autobuild import gh
+from msys2_autobuild.gh import (asset_file_is_uptodate, download_asset,
+                                get_asset_part_path)
+from msys2_autobuild.utils import PackageFilenames, parse_optional_deps
 
 
 def test_parse_optional_deps():
     assert parse_optional_deps("a:b,c:d,a:x") == {'a': ['b', 'x'], 'c': ['d']}
+
+
+def test_package_filenames():
+    filenames = PackageFilenames([
+        "mingw-w64-x86_64-foo-1.0-1-any.pkg.tar.zst",
+        "mingw-w64-x86_64-foo-bar-1.0-1-any.pkg.tar.zst",
+        "foo-2.0-1-x86_64.pkg.tar.zst",
+        "foo-2.0-1.src.tar.zst",
+    ])
+    assert filenames.filter("mingw-w64-x86_64-foo-1.0-1-*.pkg.tar.zst") == \
+        ["mingw-w64-x86_64-foo-1.0-1-any.pkg.tar.zst"]
+    assert filenames.filter("foo-2.0-1-*.pkg.tar.zst") == ["foo-2.0-1-x86_64.pkg.tar.zst"]
+    assert filenames.filter("foo-2.0-1.src.tar.[!s]*") == ["foo-2.0-1.src.tar.zst"]
+    assert filenames.filter("foo-1.0-1-*.pkg.tar.zst") == []
+
+
+class FakeRaw(io.BytesIO):
+    decode_content = False
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.raw = FakeRaw(content)
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeSession:
+
+    def __init__(self, status_code, content):
+        self.response = FakeResponse(status_code, content)
+        self.headers = None
+
+    def get(self, url, headers=None, **kwargs):
+        self.headers = headers
+        return self.response
+
+
+def make_asset(content):
+    return SimpleNamespace(
+        id=42, state="uploaded", size=len(content), name="foo.bin", label=None,
+        updated_at=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        browser_download_url="https://example.invalid/foo.bin")
+
+
+def use_session(monkeypatch, session):
+    monkeypatch.setattr(gh, "get_requests_session", lambda **kwargs: session)
+
+
+def test_download_asset_resume(monkeypatch, tmp_path):
+    asset = make_asset(b"0123456789")
+    target = str(tmp_path / "foo")
+    with open(get_asset_part_path(asset, target), "wb") as h:
+        h.write(b"0123")
+    session = FakeSession(206, b"456789")
+    use_session(monkeypatch, session)
+
+    download_asset(asset, target)
+    assert session.headers == {"Range": "bytes=4-"}
+    with open(target, "rb") as h:
+        assert h.read() == b"0123456789"
+    assert asset_file_is_uptodate(target, asset)
+    assert not (tmp_path / "foo.42.part").exists()
+
+
+def test_download_asset_range_ignored(monkeypatch, tmp_path):
+    asset = make_asset(b"0123456789")
+    target = str(tmp_path / "foo")
+    with open(get_asset_part_path(asset, target), "wb") as h:
+        h.write(b"xxxx")
+    session = FakeSession(200, b"0123456789")
+    use_session(monkeypatch, session)
+
+    download_asset(asset, target)
+    assert session.headers == {"Range": "bytes=4-"}
+    with open(target, "rb") as h:
+        assert h.read() == b"0123456789"
+    assert not (tmp_path / "foo.42.part").exists()
+
+
+def test_download_asset_short(monkeypatch, tmp_path):
+    asset = make_asset(b"0123456789")
+    target = str(tmp_path / "foo")
+    use_session(monkeypatch, FakeSession(200, b"01234"))
+
+    with pytest.raises(requests.RequestException):
+        download_asset(asset, target)
+    assert not (tmp_path / "foo").exists()
+    # kept, so the next try can resume
+    with open(get_asset_part_path(asset, target), "rb") as h:
+        assert h.read() == b"01234"